@@ -1,20 +1,39 @@
 #!/usr/bin/env python3
+import hashlib
 import json
+import os
+import re
+import shlex
+import shutil
+import sys
+import threading
 
-from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from subprocess import Popen, PIPE, DEVNULL
 from argparse import ArgumentParser
 
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
 
 class SelectableTrack:
+    __slots__ = ("raw", "index", "tags", "language", "title", "track_type",
+                 "forced", "dub", "selected")
+
     def __init__(self, track):
+        tags = track.get("tags") or {}
+        disp = track.get("disposition") or {}
         self.raw = track
-        self.track = track.get("index")
-        self.tags = track.get("tags", {})
-        self.language = self.tags.get("language")
-        self.title = self.tags.get("title")
+        self.index = track.get("index")
+        self.tags = tags
+        self.language = tags.get("language")
+        self.title = tags.get("title")
         self.track_type = track.get('codec_type')
-        self.forced = track.get('disposition', {}).get('forced', 1) == 1
-        self.dub = track.get('disposition', {}).get('dub', 1) == 1
+        self.forced = disp.get('forced', 1) == 1
+        self.dub = disp.get('dub', 1) == 1
         self.selected = False
 
     def __repr__(self):
@@ -30,50 +49,203 @@ class SelectableTrack:
             return f"[ ] {metadata}"
 
 
+@lru_cache(maxsize=None)
+def _which(name):
+    return shutil.which(name) or name
+
+
+def _spawn(args, **kwargs):
+    # subprocess only uses posix_spawn instead of fork+exec when given a path
+    # to the executable and close_fds=False; our own fds are non-inheritable
+    return Popen(args, executable=_which(args[0]), close_fds=False, **kwargs)
+
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "ffstrip")
+
+
+PROBE_ARGS = ["-v", "quiet", "-print_format", "json",
+              "-show_entries",
+              "stream=index,codec_type:stream_disposition=forced,dub"
+              ":stream_tags=language,title"]
+
+# Entries cached by an older field list must not be served for a newer one
+_CACHE_TAG = hashlib.sha1(" ".join(PROBE_ARGS).encode()).hexdigest()[:8]
+
+
+def _cache_path(fin):
+    st = os.stat(fin)
+    key = f"{_CACHE_TAG}-{st.st_dev}-{st.st_ino}-{st.st_mtime_ns}-{st.st_size}"
+    return os.path.join(CACHE_DIR, f"{key}.json")
+
+
+def _probe(fin):
+    params = ["ffprobe", fin, *PROBE_ARGS]
+    process = _spawn(params, stdout=PIPE, stderr=DEVNULL)
+    output = bytearray()
+    fd = process.stdout.fileno()
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        output += chunk
+    process.stdout.close()
+    if process.wait() != 0:
+        return False, None
+    return True, loads(bytes(output)).get("streams")
+
+
 def get_info(fin):
-    params = ["ffprobe", fin, "-v", "quiet",
-              "-print_format", "json",
-              "-show_format", "-show_streams"]
-    process = Popen(params, stdout=PIPE)
-    output, err = process.communicate()
-    exit_code = process.wait()
-    return exit_code == 0, json.loads(output).get("streams")
-
-
-def write_file(fin, fout, to_remove):
-    args = ["ffmpeg", "-i", fin, "-c", "copy", "-map", "0", "-y",
-            "-v", "error"]
+    try:
+        cache = _cache_path(fin)
+    except OSError:
+        # Not a local file (missing, or a URL ffprobe opens itself)
+        return _probe(fin)
+    try:
+        with open(cache, "rb") as f:
+            return True, loads(f.read())
+    except (OSError, ValueError):
+        pass
+    ok, streams = _probe(fin)
+    if ok and streams:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp = f"{cache}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(streams, f)
+            os.replace(tmp, cache)
+        except OSError:
+            pass
+    return ok, streams
+
+
+def _same_file(a, b):
+    try:
+        return os.path.samefile(a, b)
+    except OSError:
+        return False
+
+
+def _copy_file(fin, fout):
+    if os.path.isdir(fout):
+        print(f"{fout} is a directory")
+        return False
+    if _same_file(fin, fout):
+        return True
+    # Build the copy next to fout so a failure leaves an existing output alone
+    tmp = f"{fout}.{os.getpid()}.tmp"
+    try:
+        shutil.copyfile(fin, tmp)
+        os.replace(tmp, fout)
+    except OSError as e:
+        print(e)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+    return True
+
+
+def write_file(fin, fout, to_remove, verbose=None, fast_probe=False):
+    to_remove = list(to_remove)
+    # Nothing to drop: skip the remux unless ffmpeg has to change container
+    if (not to_remove and os.path.splitext(fin)[1].lower()
+            == os.path.splitext(fout)[1].lower()):
+        return _copy_file(fin, fout)
+    args = ["ffmpeg"]
+    if fast_probe:
+        # ffmpeg defaults to 5 MB and 5 s, scan a fifth of that
+        args.extend(("-probesize", "1000000", "-analyzeduration", "1000000"))
+    args.extend(("-i", fin, "-c", "copy", "-map", "0", "-y", "-v", "error"))
     for x in to_remove:
         args.append("-map")
         args.append(f"-0:{x}")
     args.append(fout)
-    print(" ".join(["'%s'" % x.replace("'", "\\'")
-          if " " in x else x for x in args]))
-    process = Popen(args, stdout=PIPE)
-    output, err = process.communicate()
-    exit_code = process.wait()
-    return exit_code == 0
+    # By default only echo the command to a terminal, not into logs
+    if verbose is None:
+        verbose = sys.stdout.isatty()
+    if verbose:
+        print(shlex.join(args))
+    process = _spawn(args, stdout=PIPE)
+    process.communicate()
+    return process.returncode == 0
+
+
+_DEFAULT_CODEC_TYPES = frozenset(("subtitle", "audio"))
+
 
+# (index, language, title, forced, codec_type), text lowercased
+def index_metadata(metadata):
+    idx = []
+    for m in metadata:
+        tags = m.get("tags") or {}
+        idx.append((m["index"],
+                    tags.get("language", "").lower(),
+                    tags.get("title", "").lower(),
+                    (m.get("disposition") or {}).get("forced", 1) == 1,
+                    m["codec_type"]))
+    return idx
 
-def get_track_number_by_pattern(pattern, metadata, codec_type=None):
+
+def get_track_number_by_pattern(pattern, idx, codec_type=None):
     if not codec_type:
-        codec_type = ("subtitle", "audio")
-    for meta in [x for x in metadata if x["codec_type"] in codec_type]:
-        for candidate in (meta.get("tags", {}).get("language", "").lower(),
-                          meta.get("tags", {}).get("title", "").lower(),
-                          "forced" if meta["disposition"].get("forced", 1) else ""):
-            if pattern.lower() in candidate:
-                yield meta["index"]
+        codec_type = _DEFAULT_CODEC_TYPES
+    codec_type = frozenset(codec_type)
+    if isinstance(pattern, str):
+        def match(candidate):
+            return pattern in candidate
+    else:
+        match = pattern.search
+    for index, language, title, forced, track_type in idx:
+        if track_type not in codec_type:
+            continue
+        for candidate in (language, title, "forced" if forced else ""):
+            if match(candidate):
+                yield index
+                break
+
+
+_TRACK_TYPES = {"a": ("audio",), "s": ("subtitle",)}
+
+
+def _resolve_patterns(tokens, idx):
+    digit_tracks = {int(x) for x in tokens if x.isdigit()}
+    named_tracks = set()
+    patterns = {prefix: [] for prefix in _TRACK_TYPES}
+    for track in set(tokens):
+        if track.isdigit():
+            continue
+        track = track.split(":")
+        if len(track) < 2:
+            print(f"Unrecognized pattern for {track[0]}")
+            continue
+        if track[0] in patterns:
+            patterns[track[0]].append(track[1].lower())
+    for prefix, pattern_list in patterns.items():
+        codec_type = _TRACK_TYPES[prefix]
+        if len(pattern_list) > 1:
+            # One alternation scans each candidate once for all patterns
+            pattern = re.compile("|".join(map(re.escape, pattern_list)))
+        elif pattern_list:
+            pattern = pattern_list[0]
+        else:
+            continue
+        named_tracks.update(get_track_number_by_pattern(
+            pattern, idx, codec_type))
+    return digit_tracks, named_tracks
 
 
-def main(fin, fout, strip=[], keep=[], info=False, interactive=False):
-    _, metadata = get_info(fin)
+def main(fin, fout, strip=[], keep=[], info=False, interactive=False,
+         verbose=None, fast_probe=False, probe=None):
+    _, metadata = probe or get_info(fin)
     if not metadata:
         print("No metadata was queried")
         return
     if interactive:
-        tracks = [SelectableTrack(x) for x in metadata]
-        print(tracks)
+        write = sys.stdout.write
+        for track in map(SelectableTrack, metadata):
+            write(repr(track))
+            write("\n")
     elif info:
         # print(metadata)
         for track in metadata:
@@ -94,58 +266,64 @@ def main(fin, fout, strip=[], keep=[], info=False, interactive=False):
         print("Can only strip or keep, not both")
         return
 
+    if (strip or keep) and _same_file(fin, fout):
+        print(f"Refusing to overwrite the input {fin}")
+        return
+
     if keep:
-        digit_tracks = [int(x) for x in keep if x.isdigit()]
-        named_tracks = []
-        for track in set(keep) - set(digit_tracks):
-            track = track.split(":")
-            if len(track) < 2:
-                print(f"Unrecognized pattern for {track[0]}")
-                continue
-            if track[0] == "a":
-                named_tracks.extend(get_track_number_by_pattern(
-                    track[1], metadata, ("audio",)))
-            elif track[0] == "s":
-                named_tracks.extend(get_track_number_by_pattern(
-                    track[1], metadata, ("subtitle",)))
-        track_to_strip = (set([m["index"] for m in metadata
-                              if m["codec_type"] in ("audio", "subtitle")])
-                          - set(named_tracks))
-        for d in digit_tracks:
-            if d in track_to_strip:
-                track_to_strip.remove(d)
-        write_file(fin, fout, track_to_strip)
+        digit_tracks, named_tracks = _resolve_patterns(
+            keep, index_metadata(metadata))
+        av_indices = frozenset(m["index"] for m in metadata
+                               if m["codec_type"] in _DEFAULT_CODEC_TYPES)
+        write_file(fin, fout, av_indices - named_tracks - digit_tracks,
+                   verbose=verbose, fast_probe=fast_probe)
     elif strip:
-        digit_tracks = [int(x) for x in strip if x.isdigit()]
-        named_tracks = []
-        for track in set(strip) - set(digit_tracks):
-            track = track.split(":")
-            if len(track) < 2:
-                print(f"Unrecognized pattern for {track[0]}")
+        digit_tracks, named_tracks = _resolve_patterns(
+            strip, index_metadata(metadata))
+        write_file(fin, fout, sorted(digit_tracks | named_tracks),
+                   verbose=verbose, fast_probe=fast_probe)
+
+
+def main_batch(inputs, output, **kwargs):
+    batch = len(inputs) > 1
+    if batch and output and not os.path.isdir(output):
+        print("Output must be a directory when processing several files")
+        return
+    names = [os.path.basename(fin) for fin in inputs]
+    if batch and output and len(set(names)) < len(names):
+        print("Inputs with the same file name would overwrite each other")
+        return
+    # Probe everything up front so ffprobe runs while earlier files are muxed
+    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as pool:
+        probes = [pool.submit(get_info, fin) for fin in inputs]
+        for fin, probe in zip(inputs, probes):
+            if batch:
+                print(f"{fin}:")
+            try:
+                result = probe.result()
+            except (OSError, ValueError) as e:
+                print(e)
                 continue
-            if track[0] == "a":
-                named_tracks.extend(get_track_number_by_pattern(
-                    track[1], metadata, ("audio",)))
-            elif track[0] == "s":
-                named_tracks.extend(get_track_number_by_pattern(
-                    track[1], metadata, ("subtitle",)))
-        track_to_strip = set()
-        track_to_strip.update(digit_tracks)
-        track_to_strip.update(filter(lambda x: x, named_tracks))
-        write_file(fin, fout, digit_tracks + named_tracks)
+            fout = output
+            if batch and output:
+                fout = os.path.join(output, os.path.basename(fin))
+            main(fin, fout, probe=result, **kwargs)
 
 
 if __name__ == "__main__":
     parser = ArgumentParser(
         description="Strip or keep the selected tracks from files")
-    parser.add_argument("input", action="store")
+    parser.add_argument("input", action="store", nargs="+")
     parser.add_argument("--output", "-o", action="store")
     parser.add_argument("--strip", "-s", action="store",
                         nargs="+", required=False)
     parser.add_argument("--keep", "-k", action="store",
                         nargs="+", required=False)
     parser.add_argument("--info", action="store_true")
+    parser.add_argument("--verbose", "-v", action="store_true", default=None)
+    parser.add_argument("--fast-probe", action="store_true")
 
     args = parser.parse_args()
-    main(args.input, args.output, strip=args.strip, keep=args.keep,
-         info=args.info)
+    main_batch(args.input, args.output, strip=args.strip, keep=args.keep,
+               info=args.info, verbose=args.verbose,
+               fast_probe=args.fast_probe)